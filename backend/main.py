@@ -3,14 +3,20 @@ from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import StreamingResponse
 import uvicorn
 import os
+import json
 from contextlib import asynccontextmanager
+from sqlalchemy import select
 
-from database import engine, SessionLocal, Base
+from database import engine, async_engine, AsyncSessionLocal, Base
 from models import Document, Chunk, Category, QueryHistory
-from services.document_service import DocumentService
+from services.document_service import DocumentService, SUPPORTED_EXTENSIONS
 from services.embedding_service import EmbeddingService
 from services.query_service import QueryService
 from services.graph_service import GraphService
+from services.cache import (
+    redis_cache, invalidate,
+    DOCUMENTS_CACHE_KEY, CATEGORIES_CACHE_KEY, QUERY_HISTORY_CACHE_KEY
+)
 from config import settings
 
 # Create tables
@@ -26,6 +32,7 @@ async def lifespan(app: FastAPI):
     app.state.embedding_service = EmbeddingService()
     app.state.query_service = QueryService()
     app.state.graph_service = GraphService()
+    await app.state.query_service.semantic_cache.create_index()
     
     # Scan documents folder on startup (disabled for now)
     # if os.path.exists(settings.DOCUMENTS_PATH):
@@ -35,6 +42,8 @@ async def lifespan(app: FastAPI):
     
     # Shutdown
     print("Shutting down...")
+    await app.state.graph_service.close()
+    await async_engine.dispose()
 
 app = FastAPI(
     title="RAG Document Chat API",
@@ -53,12 +62,9 @@ app.add_middleware(
 )
 
 # Dependency to get database session
-def get_db():
-    db = SessionLocal()
-    try:
+async def get_db():
+    async with AsyncSessionLocal() as db:
         yield db
-    finally:
-        db.close()
 
 @app.get("/")
 async def root():
@@ -66,7 +72,10 @@ async def root():
 
 @app.get("/health")
 async def health_check():
-    return {"status": "healthy"}
+    return {
+        "status": "healthy",
+        "query_embedding_cache": app.state.query_service.embedding_service.cache_stats()
+    }
 
 # Document endpoints
 @app.post("/api/documents/upload")
@@ -83,15 +92,17 @@ async def upload_document(
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/documents")
+@redis_cache(DOCUMENTS_CACHE_KEY, ttl=60)
 async def list_documents(db = Depends(get_db)):
     """List all documents"""
-    documents = db.query(Document).all()
-    return documents
+    result = await db.execute(select(Document))
+    return result.scalars().all()
 
 @app.get("/api/documents/{document_id}")
 async def get_document(document_id: str, db = Depends(get_db)):
     """Get document details"""
-    document = db.query(Document).filter(Document.id == document_id).first()
+    result = await db.execute(select(Document).where(Document.id == document_id))
+    document = result.scalars().first()
     if not document:
         raise HTTPException(status_code=404, detail="Document not found")
     return document
@@ -134,20 +145,30 @@ async def stream_query(
     language: str = Form("hr"),
     category: str = Form(None)
 ):
-    """Submit a query and get streaming response"""
+    """Submit a query and get a Server-Sent Events stream of response tokens"""
+    async def event_stream():
+        async for token in app.state.query_service.stream_query(query, language, category):
+            yield f"data: {json.dumps({'delta': token}, ensure_ascii=False)}\n\n"
+        yield "data: [DONE]\n\n"
+    
     try:
         return StreamingResponse(
-            app.state.query_service.stream_query(query, language, category),
-            media_type="text/plain"
+            event_stream(),
+            media_type="text/event-stream",
+            headers={
+                "Cache-Control": "no-cache",
+                "X-Accel-Buffering": "no"  # Stop nginx from buffering the stream
+            }
         )
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 @app.get("/api/query/history")
+@redis_cache(QUERY_HISTORY_CACHE_KEY, ttl=60)
 async def get_query_history(db = Depends(get_db)):
     """Get query history"""
-    history = db.query(QueryHistory).order_by(QueryHistory.created_at.desc()).limit(50).all()
-    return history
+    result = await db.execute(select(QueryHistory).order_by(QueryHistory.created_at.desc()).limit(50))
+    return result.scalars().all()
 
 @app.post("/api/query/feedback")
 async def submit_feedback(
@@ -156,16 +177,19 @@ async def submit_feedback(
     db = Depends(get_db)
 ):
     """Submit feedback on a query response"""
-    query = db.query(QueryHistory).filter(QueryHistory.id == query_id).first()
+    result = await db.execute(select(QueryHistory).where(QueryHistory.id == query_id))
+    query = result.scalars().first()
     if not query:
         raise HTTPException(status_code=404, detail="Query not found")
     
     query.feedback_score = score
-    db.commit()
+    await db.commit()
+    await invalidate(QUERY_HISTORY_CACHE_KEY)
     return {"message": "Feedback submitted successfully"}
 
 # Category endpoints
 @app.get("/api/categories")
+@redis_cache(CATEGORIES_CACHE_KEY, ttl=60)
 async def list_categories(db = Depends(get_db)):
     """List all categories based on actual document folders"""
     import os
@@ -179,7 +203,7 @@ async def list_categories(db = Depends(get_db)):
             if os.path.isdir(item_path) and item != "general":
                 # Check if there are documents in this folder
                 has_documents = any(
-                    f.lower().endswith(('.pdf', '.docx', '.txt', '.md'))
+                    f.lower().endswith(SUPPORTED_EXTENSIONS)
                     for f in os.listdir(item_path)
                 )
                 if has_documents:
@@ -211,8 +235,9 @@ async def create_category(
         description=description
     )
     db.add(category)
-    db.commit()
-    db.refresh(category)
+    await db.commit()
+    await db.refresh(category)
+    await invalidate(CATEGORIES_CACHE_KEY)
     return category
 
 @app.get("/api/categories/{category_id}/graph")
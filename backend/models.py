@@ -1,8 +1,10 @@
-from sqlalchemy import Column, String, Integer, DateTime, Text, BigInteger, ForeignKey
+from sqlalchemy import Column, String, Integer, DateTime, Text, BigInteger, ForeignKey, Index, LargeBinary
 from sqlalchemy.dialects.postgresql import UUID, JSONB
 from sqlalchemy.orm import relationship
 from sqlalchemy.sql import func
+from pgvector.sqlalchemy import Vector
 from database import Base
+from config import settings
 import uuid
 
 class Document(Base):
@@ -30,12 +32,22 @@ class Chunk(Base):
     chunk_index = Column(Integer, nullable=False)
     content = Column(Text, nullable=False)
     language = Column(String(2), default='hr')
-    embedding = Column("embedding", String)  # Will store as vector in PostgreSQL
+    embedding = Column(Vector(settings.EMBEDDING_DIM))
+    embedding_quantized = Column(LargeBinary)  # Packed int8/float16/float32 copy used by exact search
     chunk_metadata = Column(JSONB, default={})
     created_at = Column(DateTime, server_default=func.now())
     
     # Relationship to document
     document = relationship("Document", back_populates="chunks")
+    
+    __table_args__ = (
+        Index(
+            "chunks_embedding_idx",
+            "embedding",
+            postgresql_using="hnsw",
+            postgresql_ops={"embedding": "vector_cosine_ops"}
+        ),
+    )
 
 class Category(Base):
     __tablename__ = "categories"
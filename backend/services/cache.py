@@ -0,0 +1,111 @@
+import asyncio
+import functools
+import logging
+import weakref
+from typing import Any, Optional
+import orjson
+import redis.asyncio as redis
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Response cache keys for list endpoints
+DOCUMENTS_CACHE_KEY = "documents:all"
+CATEGORIES_CACHE_KEY = "categories:all"
+QUERY_HISTORY_CACHE_KEY = "query_history:recent"
+
+# Query history rows waiting to be written to Postgres in bulk, and rows that
+# repeatedly failed to insert (kept for inspection rather than retried forever)
+QUERY_HISTORY_BUFFER_KEY = "query_history:buffer"
+QUERY_HISTORY_DEAD_LETTER_KEY = "query_history:dead_letter"
+
+# Bumped whenever a category's content changes; "all" covers unfiltered queries.
+# Chunks in Postgres and the Neo4j graph are versioned separately.
+GENERATION_KEY = "generation:{}:{}"
+CONTENT_GENERATION = "content"
+GRAPH_GENERATION = "graph"
+ALL_CATEGORIES = "all"
+
+# asyncio Redis connections are tied to the event loop that opened them, so keep
+# one client per loop (the API's loop and each Celery worker process's loop).
+# Every service goes through get_redis() rather than holding its own client.
+_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, redis.Redis]" = weakref.WeakKeyDictionary()
+
+def get_redis() -> redis.Redis:
+    """Return the Redis client for the running event loop"""
+    loop = asyncio.get_running_loop()
+    client = _clients.get(loop)
+    if client is None:
+        client = redis.from_url(settings.REDIS_URL)
+        _clients[loop] = client
+    return client
+
+def redis_cache(key: str, ttl: int = 60):
+    """Cache a JSON endpoint's serialized response body in Redis"""
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            try:
+                cached = await get_redis().get(key)
+                if cached is not None:
+                    return Response(content=cached, media_type="application/json")
+            except Exception as e:
+                logger.warning(f"Response cache lookup failed for {key}: {e}")
+            
+            result = await func(*args, **kwargs)
+            body = orjson.dumps(jsonable_encoder(result))
+            
+            try:
+                await get_redis().set(key, body, ex=ttl)
+            except Exception as e:
+                logger.warning(f"Response cache write failed for {key}: {e}")
+            
+            return Response(content=body, media_type="application/json")
+        return wrapper
+    return decorator
+
+async def get_json(key: str) -> Optional[Any]:
+    """Read a JSON value, treating Redis errors as a miss"""
+    try:
+        cached = await get_redis().get(key)
+        return orjson.loads(cached) if cached is not None else None
+    except Exception as e:
+        logger.warning(f"Cache lookup failed for {key}: {e}")
+        return None
+
+async def set_json(key: str, value: Any, ttl: int):
+    """Write a JSON value with a TTL"""
+    try:
+        await get_redis().set(key, orjson.dumps(value), ex=ttl)
+    except Exception as e:
+        logger.warning(f"Cache write failed for {key}: {e}")
+
+async def get_generation(category: Optional[str], kind: str = CONTENT_GENERATION) -> Optional[int]:
+    """Current generation for a category, or None if Redis is unavailable"""
+    try:
+        value = await get_redis().get(GENERATION_KEY.format(kind, category or ALL_CATEGORIES))
+        return int(value) if value is not None else 0
+    except Exception as e:
+        logger.warning(f"Generation lookup failed for {category}: {e}")
+        return None
+
+async def bump_generation(category: Optional[str], kind: str = CONTENT_GENERATION):
+    """Retire cached results that depend on a category's content"""
+    try:
+        async with get_redis().pipeline(transaction=False) as pipe:
+            if category:
+                pipe.incr(GENERATION_KEY.format(kind, category))
+            pipe.incr(GENERATION_KEY.format(kind, ALL_CATEGORIES))
+            await pipe.execute()
+    except Exception as e:
+        logger.warning(f"Generation bump failed for {category}: {e}")
+
+async def invalidate(*keys: str):
+    """Drop cached responses after a write"""
+    try:
+        await get_redis().delete(*keys)
+    except Exception as e:
+        logger.warning(f"Response cache invalidation failed for {keys}: {e}")
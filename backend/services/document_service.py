@@ -1,173 +1,331 @@
 import os
+import uuid
 import hashlib
 import aiofiles
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional
 from fastapi import UploadFile
 import logging
 from datetime import datetime
 import asyncio
+from concurrent.futures import ThreadPoolExecutor
 
-from database import SessionLocal
+from sqlalchemy import select
+
+from database import AsyncSessionLocal
 from models import Document, Chunk
-from services.text_processor import TextProcessor
+from services.text_processor import TextProcessor, LANGUAGE_SAMPLE_CHARS
 from services.embedding_service import EmbeddingService
+from services.graph_service import GraphService
+from services.cache import invalidate, bump_generation, DOCUMENTS_CACHE_KEY, CATEGORIES_CACHE_KEY
 from config import settings
 
 logger = logging.getLogger(__name__)
 
+# Read size used when streaming uploads to disk
+UPLOAD_CHUNK_SIZE = 64 * 1024
+
+# File types the text processor can extract (tuple so str.endswith can test all at once)
+SUPPORTED_EXTENSIONS = ('.pdf', '.docx', '.txt', '.md')
+
+# Documents processed concurrently after a folder scan
+SCAN_PROCESSING_CONCURRENCY = 4
+
+# Dedicated pool for file hashing. OpenSSL releases the GIL while hashing, so
+# threads scale across cores and disk queue depth without competing with the
+# default executor used for embedding.
+_HASH_EXECUTOR = ThreadPoolExecutor(max_workers=settings.HASH_WORKERS, thread_name_prefix="file-hash")
+
+def _hash_file(file_path: str) -> str:
+    """SHA-256 of a file on disk.
+    
+    hashlib.file_digest (Python 3.11+) reads into a reusable buffer and feeds
+    OpenSSL directly, so no per-chunk Python loop or whole-file bytes object.
+    """
+    with open(file_path, 'rb') as f:
+        return hashlib.file_digest(f, 'sha256').hexdigest()
+
+def _iter_supported_files(root: str):
+    """Recursively yield DirEntry objects for supported files, filtering on name before any stat"""
+    with os.scandir(root) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_supported_files(entry.path)
+            elif entry.name.lower().endswith(SUPPORTED_EXTENSIONS) and entry.is_file(follow_symlinks=False):
+                yield entry
+
 class DocumentService:
     def __init__(self):
         self.text_processor = TextProcessor()
         self.embedding_service = EmbeddingService()
+        self.graph_service = GraphService()
     
     async def upload_document(self, file: UploadFile, category: str, language: str) -> Dict[str, Any]:
         """Upload and process a new document"""
+        temp_path = None
         try:
-            # Validate file
-            if file.size > settings.MAX_FILE_SIZE:
+            # Reject early when the client declares an oversized body
+            if file.size is not None and file.size > settings.MAX_FILE_SIZE:
                 raise ValueError(f"File too large. Max size: {settings.MAX_FILE_SIZE} bytes")
             
-            # Read file content
-            content = await file.read()
-            file_hash = hashlib.sha256(content).hexdigest()
-            
-            # Check if document already exists
-            db = SessionLocal()
-            existing_doc = db.query(Document).filter(Document.file_hash == file_hash).first()
-            if existing_doc:
-                db.close()
-                return {"message": "Document already exists", "document_id": str(existing_doc.id)}
-            
-            # Save file to disk
             file_path = os.path.join(settings.DOCUMENTS_PATH, category, file.filename)
             os.makedirs(os.path.dirname(file_path), exist_ok=True)
             
-            async with aiofiles.open(file_path, 'wb') as f:
-                await f.write(content)
+            # Stream the upload to a temporary file, hashing in the same pass
+            temp_path = f"{file_path}.{uuid.uuid4().hex}.part"
+            hasher = hashlib.sha256()
+            file_size = 0
+            
+            async with aiofiles.open(temp_path, 'wb') as f:
+                while chunk := await file.read(UPLOAD_CHUNK_SIZE):
+                    # Enforce the limit on bytes actually received, not the declared size
+                    file_size += len(chunk)
+                    if file_size > settings.MAX_FILE_SIZE:
+                        raise ValueError(f"File too large. Max size: {settings.MAX_FILE_SIZE} bytes")
+                    hasher.update(chunk)
+                    await f.write(chunk)
+            
+            file_hash = hasher.hexdigest()
             
-            # Create document record
-            document = Document(
-                filename=file.filename,
-                category=category,
-                file_hash=file_hash,
-                language=language,
-                file_size=file.size,
-                file_path=file_path,
-                doc_metadata={"original_filename": file.filename}
-            )
+            async with AsyncSessionLocal() as db:
+                # Check if document already exists
+                result = await db.execute(select(Document).where(Document.file_hash == file_hash))
+                existing_doc = result.scalars().first()
+                if existing_doc:
+                    return {"message": "Document already exists", "document_id": str(existing_doc.id)}
+                
+                # Move file into place
+                os.replace(temp_path, file_path)
+                
+                # Create document record
+                document = Document(
+                    filename=file.filename,
+                    category=category,
+                    file_hash=file_hash,
+                    language=language,
+                    file_size=file_size,
+                    file_path=file_path,
+                    doc_metadata={"original_filename": file.filename}
+                )
+                
+                db.add(document)
+                await db.commit()
+                document_id = document.id
             
-            db.add(document)
-            db.commit()
-            db.refresh(document)
+            await invalidate(DOCUMENTS_CACHE_KEY, CATEGORIES_CACHE_KEY)
             
             # Process document asynchronously
-            asyncio.create_task(self._process_document(document.id))
+            asyncio.create_task(self._process_document(document_id))
             
-            db.close()
-            return {"message": "Document uploaded successfully", "document_id": str(document.id)}
+            return {"message": "Document uploaded successfully", "document_id": str(document_id)}
             
         except Exception as e:
             logger.error(f"Failed to upload document: {e}")
             raise
+        finally:
+            # Duplicate, oversized or failed uploads leave no partial file behind
+            if temp_path and os.path.exists(temp_path):
+                os.remove(temp_path)
     
-    async def _process_document(self, document_id: str):
-        """Process document and generate embeddings"""
+    async def _process_document(
+        self,
+        document_id: str,
+        chunks: Optional[List[Dict[str, Any]]] = None,
+        language: Optional[str] = None
+    ) -> bool:
+        """Process document and generate embeddings.
+        
+        chunks (split in language) may be passed in when extraction and splitting
+        already ran elsewhere. Returns whether the document ended up processed.
+        """
         try:
-            db = SessionLocal()
-            document = db.query(Document).filter(Document.id == document_id).first()
-            
-            if not document:
-                logger.error(f"Document not found: {document_id}")
-                return
-            
-            logger.info(f"Processing document: {document.filename}")
-            
-            # Extract text from document
-            text_content = await self.text_processor.extract_text(document.file_path)
-            
-            # Split into chunks
-            chunks = self.text_processor.split_text(text_content, document.language)
-            
-            # Generate embeddings for chunks
-            chunk_texts = [chunk["content"] for chunk in chunks]
-            embeddings = self.embedding_service.generate_embeddings_batch(chunk_texts, document.language)
-            
-            # Save chunks to database
-            for i, (chunk_data, embedding) in enumerate(zip(chunks, embeddings)):
-                chunk = Chunk(
-                    document_id=document.id,
-                    chunk_index=i,
-                    content=chunk_data["content"],
-                    language=document.language,
-                    embedding=str(embedding),  # Store as string for now
-                    chunk_metadata=chunk_data.get("metadata", {})
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(select(Document).where(Document.id == document_id))
+                document = result.scalars().first()
+                
+                if not document:
+                    logger.error(f"Document not found: {document_id}")
+                    return False
+                
+                # Content with this hash already has chunks (a retry, or the upload task and
+                # update_embeddings_task both picking it up): keep them instead of re-embedding
+                result = await db.execute(
+                    select(Chunk.id).join(Document).where(Document.file_hash == document.file_hash).limit(1)
                 )
-                db.add(chunk)
-            
-            # Update document processing timestamp
-            document.last_processed = datetime.utcnow()
-            db.commit()
-            
-            logger.info(f"Document processed successfully: {document.filename} ({len(chunks)} chunks)")
+                if result.first() is not None:
+                    logger.info(f"Chunks already exist for {document.filename}, skipping embedding")
+                    if document.last_processed is None:
+                        document.last_processed = datetime.utcnow()
+                        await db.commit()
+                    return True
+                
+                logger.info(f"Processing document: {document.filename}")
+                
+                doc_metadata = dict(document.doc_metadata or {})
+                
+                if chunks is None:
+                    # Extract text from document
+                    text_content = await self.text_processor.extract_text(document.file_path)
+                    
+                    # Scanned documents get their language from the text extracted here
+                    if doc_metadata.get("detect_language"):
+                        language = self.text_processor.detect_language(text_content[:LANGUAGE_SAMPLE_CHARS])
+                    
+                    # Split into chunks
+                    chunks = self.text_processor.split_text(text_content, language or document.language)
+                
+                if language:
+                    document.language = language
+                if doc_metadata.pop("detect_language", None):
+                    document.doc_metadata = doc_metadata
+                
+                # The document node must exist before chunk nodes can attach to it
+                await self.graph_service.create_document_node(str(document.id), {
+                    "filename": document.filename,
+                    "category": document.category,
+                    "language": document.language,
+                    "upload_date": document.upload_date.isoformat() if document.upload_date else None
+                })
+                
+                # Chunk nodes left by an earlier run whose Postgres commit never landed
+                # would otherwise sit next to the new ones with stale ids
+                await self.graph_service.delete_chunk_nodes(str(document.id))
+                
+                # Embed one batch at a time and write it to Postgres and Neo4j together
+                batch_size = settings.EMBEDDING_BATCH_SIZE
+                for start in range(0, len(chunks), batch_size):
+                    batch = chunks[start:start + batch_size]
+                    embeddings = await self.embedding_service.generate_embeddings_batch(
+                        [chunk_data["content"] for chunk_data in batch], document.language
+                    )
+                    packed_embeddings = self.embedding_service.pack_embeddings(embeddings)
+                    
+                    # Assign ids up front so both stores share them
+                    rows = [
+                        Chunk(
+                            id=uuid.uuid4(),
+                            document_id=document.id,
+                            chunk_index=start + i,
+                            content=chunk_data["content"],
+                            language=document.language,
+                            embedding=embedding,
+                            embedding_quantized=packed,
+                            chunk_metadata=chunk_data.get("metadata", {})
+                        )
+                        for i, (chunk_data, embedding, packed) in enumerate(zip(batch, embeddings, packed_embeddings))
+                    ]
+                    db.add_all(rows)
+                    
+                    # Let both writes settle before failing, so cleanup cannot race the graph write
+                    outcomes = await asyncio.gather(
+                        db.flush(),
+                        self.graph_service.create_chunk_nodes(str(document.id), [
+                            {
+                                "id": str(row.id),
+                                "content": row.content,
+                                "chunk_index": row.chunk_index,
+                                "language": row.language
+                            }
+                            for row in rows
+                        ]),
+                        return_exceptions=True
+                    )
+                    for outcome in outcomes:
+                        if isinstance(outcome, BaseException):
+                            raise outcome
+                
+                await self.graph_service.create_category_relationships(document.category)
+                
+                # Update document processing timestamp
+                document.last_processed = datetime.utcnow()
+                await db.commit()
+                await invalidate(DOCUMENTS_CACHE_KEY)
+                await bump_generation(document.category)
+                
+                logger.info(f"Document processed successfully: {document.filename} ({len(chunks)} chunks)")
+                return True
             
         except Exception as e:
             logger.error(f"Failed to process document {document_id}: {e}")
-        finally:
-            db.close()
+            # Postgres rolled back, so drop the chunk nodes written alongside it
+            await self.graph_service.delete_chunk_nodes(str(document_id))
+            return False
     
-    async def scan_documents_folder(self) -> Dict[str, Any]:
-        """Scan documents folder and process new/modified files"""
+    async def scan_documents_folder(self, wait: bool = False) -> Dict[str, Any]:
+        """Scan documents folder and process new/modified files.
+        
+        With wait, processing finishes before returning and "processed" counts the
+        documents that were processed; otherwise it runs in the background and
+        "processed" counts the documents queued.
+        """
         try:
             if not os.path.exists(settings.DOCUMENTS_PATH):
                 os.makedirs(settings.DOCUMENTS_PATH)
                 return {"message": "Documents folder created", "processed": 0}
             
-            processed_count = 0
-            db = SessionLocal()
-            
-            # Walk through documents folder
-            for root, dirs, files in os.walk(settings.DOCUMENTS_PATH):
+            # Pass 1: collect supported files and hash them concurrently
+            candidates = []
+            for entry in _iter_supported_files(settings.DOCUMENTS_PATH):
+                root = os.path.dirname(entry.path)
                 category = os.path.basename(root) if root != settings.DOCUMENTS_PATH else "general"
+                candidates.append((entry.path, entry.name, category, entry.stat().st_size))
+            
+            loop = asyncio.get_running_loop()
+            file_hashes = await asyncio.gather(*(
+                loop.run_in_executor(_HASH_EXECUTOR, _hash_file, candidate[0]) for candidate in candidates
+            ))
+            
+            # Pass 2: one dedup query and one insert for all new documents
+            document_ids = []
+            async with AsyncSessionLocal() as db:
+                known_hashes = set()
+                if file_hashes:
+                    result = await db.execute(
+                        select(Document.file_hash).where(Document.file_hash.in_(set(file_hashes)))
+                    )
+                    known_hashes = set(result.scalars().all())
                 
-                for filename in files:
-                    if not self._is_supported_file(filename):
-                        continue
-                    
-                    file_path = os.path.join(root, filename)
-                    
-                    # Calculate file hash
-                    with open(file_path, 'rb') as f:
-                        file_hash = hashlib.sha256(f.read()).hexdigest()
-                    
-                    # Check if document exists and is up to date
-                    existing_doc = db.query(Document).filter(Document.file_hash == file_hash).first()
-                    if existing_doc:
+                documents = []
+                for (file_path, filename, category, file_size), file_hash in zip(candidates, file_hashes):
+                    # Also skips identical files seen earlier in this scan
+                    if file_hash in known_hashes:
                         continue
+                    known_hashes.add(file_hash)
                     
-                    # Detect language
-                    language = self.text_processor.detect_language(file_path)
-                    
-                    # Create document record
-                    document = Document(
+                    # Assign ids up front so they can be used without reloading after commit
+                    document_id = uuid.uuid4()
+                    documents.append(Document(
+                        id=document_id,
                         filename=filename,
                         category=category,
                         file_hash=file_hash,
-                        language=language,
-                        file_size=os.path.getsize(file_path),
+                        language=settings.DEFAULT_LANGUAGE,
+                        file_size=file_size,
                         file_path=file_path,
-                        doc_metadata={"scanned": True}
-                    )
-                    
-                    db.add(document)
-                    db.commit()
-                    db.refresh(document)
-                    
-                    # Process document
-                    asyncio.create_task(self._process_document(document.id))
-                    processed_count += 1
+                        # Language is detected from the extracted text during processing
+                        doc_metadata={"scanned": True, "detect_language": True}
+                    ))
+                    document_ids.append(document_id)
+                
+                if documents:
+                    db.add_all(documents)
+                    await db.commit()
+                    await invalidate(DOCUMENTS_CACHE_KEY, CATEGORIES_CACHE_KEY)
+            
+            # Process new documents without swamping the embedding model
+            semaphore = asyncio.Semaphore(SCAN_PROCESSING_CONCURRENCY)
+            
+            async def process(document_id) -> bool:
+                async with semaphore:
+                    return await self._process_document(document_id)
+            
+            if wait:
+                results = await asyncio.gather(*(process(document_id) for document_id in document_ids))
+                return {"message": f"Scanned documents folder", "processed": sum(results)}
             
-            db.close()
-            return {"message": f"Scanned documents folder", "processed": processed_count}
+            for document_id in document_ids:
+                asyncio.create_task(process(document_id))
+            
+            return {"message": f"Scanned documents folder", "processed": len(document_ids)}
             
         except Exception as e:
             logger.error(f"Failed to scan documents folder: {e}")
@@ -176,28 +334,29 @@ class DocumentService:
     async def delete_document(self, document_id: str) -> Dict[str, Any]:
         """Delete a document and its chunks"""
         try:
-            db = SessionLocal()
-            document = db.query(Document).filter(Document.id == document_id).first()
-            
-            if not document:
-                raise ValueError("Document not found")
+            async with AsyncSessionLocal() as db:
+                result = await db.execute(select(Document).where(Document.id == document_id))
+                document = result.scalars().first()
+                
+                if not document:
+                    raise ValueError("Document not found")
+                
+                # Delete file from disk
+                if document.file_path and os.path.exists(document.file_path):
+                    os.remove(document.file_path)
+                
+                # Delete from database (chunks will be deleted due to cascade)
+                category = document.category
+                await db.delete(document)
+                await db.commit()
             
-            # Delete file from disk
-            if document.file_path and os.path.exists(document.file_path):
-                os.remove(document.file_path)
+            await self.graph_service.delete_document_graph(document_id)
             
-            # Delete from database (chunks will be deleted due to cascade)
-            db.delete(document)
-            db.commit()
-            db.close()
+            await invalidate(DOCUMENTS_CACHE_KEY, CATEGORIES_CACHE_KEY)
+            await bump_generation(category)
             
             return {"message": "Document deleted successfully"}
             
         except Exception as e:
             logger.error(f"Failed to delete document {document_id}: {e}")
-            raise
-    
-    def _is_supported_file(self, filename: str) -> bool:
-        """Check if file type is supported"""
-        supported_extensions = ['.pdf', '.docx', '.txt', '.md']
-        return any(filename.lower().endswith(ext) for ext in supported_extensions)
\ No newline at end of file
+            raise
\ No newline at end of file
@@ -1,46 +1,267 @@
-from sentence_transformers import SentenceTransformer
 import numpy as np
-from typing import List, Union
+import torch
+import torch.nn.functional as F
+from transformers import AutoModel, AutoTokenizer
+import asyncio
+import hashlib
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from typing import Dict, List, Optional, Union
 from config import settings
+from services.cache import get_redis
 import logging
 
 logger = logging.getLogger(__name__)
 
+# Per-row scale header of scaled int8 embeddings
+_INT8_SCALE_DTYPE = np.dtype("<f4")
+
+class _PooledEncoder(ABC):
+    """SentenceTransformer-compatible encode() over a tokenizer + transformer.
+    
+    Applies the same mean pooling and L2 normalization as the e5 SentenceTransformer
+    pipeline. Subclasses provide the tokenizer, the model and _encode_batch.
+    """
+    
+    max_length = 512
+    
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.config.hidden_size
+    
+    def encode(self, sentences: Union[str, List[str]], batch_size: int = 32, normalize_embeddings: bool = True, **kwargs) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        
+        # Batch texts of similar length together to minimise padding
+        order = np.argsort([-len(text) for text in texts], kind="stable")
+        embeddings = np.empty((len(texts), self.get_sentence_embedding_dimension()), dtype=np.float32)
+        for start in range(0, len(texts), batch_size):
+            indices = order[start:start + batch_size]
+            embeddings[indices] = self._encode_batch([texts[i] for i in indices], normalize_embeddings)
+        
+        return embeddings[0] if single else embeddings
+    
+    @abstractmethod
+    def _encode_batch(self, texts: List[str], normalize: bool) -> np.ndarray:
+        """Pooled (optionally normalized) float32 embeddings for one batch"""
+
+class TorchEncoder(_PooledEncoder):
+    """Hugging Face model run directly under torch.inference_mode.
+    
+    The fast (Rust) tokenizer and the model stay loaded across calls, skipping
+    SentenceTransformer's per-call setup.
+    """
+    
+    def __init__(self, model_name: str):
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        self.tokenizer = AutoTokenizer.from_pretrained(model_name, use_fast=True)
+        self.model = AutoModel.from_pretrained(model_name).to(self.device).eval()
+    
+    def _encode_batch(self, texts: List[str], normalize: bool) -> np.ndarray:
+        with torch.inference_mode():
+            inputs = self.tokenizer(
+                texts,
+                padding=True,
+                truncation=True,
+                max_length=self.max_length,
+                return_tensors="pt"
+            ).to(self.device)
+            hidden = self.model(**inputs).last_hidden_state
+            
+            # Mean pooling over non-padding tokens
+            mask = inputs["attention_mask"].unsqueeze(-1).to(hidden.dtype)
+            pooled = (hidden * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1e-9)
+            if normalize:
+                pooled = F.normalize(pooled, p=2, dim=-1)
+            return pooled.float().cpu().numpy()
+
+class OnnxEncoder(_PooledEncoder):
+    """Exported ONNX Runtime model, interchangeable with the PyTorch backend"""
+    
+    def __init__(self, model_path: str):
+        # Optional dependency, only needed when EMBEDDING_ONNX_PATH is set
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path, use_fast=True)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_path)
+    
+    def _encode_batch(self, texts: List[str], normalize: bool) -> np.ndarray:
+        inputs = self.tokenizer(
+            texts,
+            padding=True,
+            truncation=True,
+            max_length=self.max_length,
+            return_tensors="np"
+        )
+        hidden = self.model(**inputs).last_hidden_state
+        
+        # Mean pooling over non-padding tokens
+        mask = inputs["attention_mask"][..., None].astype(np.float32)
+        pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+        if normalize:
+            pooled /= np.linalg.norm(pooled, axis=1, keepdims=True)
+        return pooled.astype(np.float32)
+
 class EmbeddingService:
     def __init__(self):
         self.model = None
+        self.model_id = settings.EMBEDDING_ONNX_PATH or settings.EMBEDDING_MODEL
+        self.dimension = None
+        
+        # In-process LRU of query embeddings, checked before Redis
+        self._query_cache: OrderedDict = OrderedDict()
+        self.query_cache_hits = 0
+        self.query_cache_misses = 0
+        
+        # Micro-batching of concurrent single-text encodes
+        self._batch_queue: Optional[asyncio.Queue] = None
+        self._batch_worker: Optional[asyncio.Task] = None
+        self._batch_loop: Optional[asyncio.AbstractEventLoop] = None
+        
         self._load_model()
     
     def _load_model(self):
         """Load the embedding model"""
         try:
-            logger.info(f"Loading embedding model: {settings.EMBEDDING_MODEL}")
-            self.model = SentenceTransformer(settings.EMBEDDING_MODEL)
+            if settings.EMBEDDING_ONNX_PATH:
+                logger.info(f"Loading ONNX embedding model: {settings.EMBEDDING_ONNX_PATH}")
+                self.model = OnnxEncoder(settings.EMBEDDING_ONNX_PATH)
+            else:
+                logger.info(f"Loading embedding model: {settings.EMBEDDING_MODEL}")
+                self.model = TorchEncoder(settings.EMBEDDING_MODEL)
+            self.dimension = self.model.get_sentence_embedding_dimension()
             logger.info("Embedding model loaded successfully")
         except Exception as e:
             logger.error(f"Failed to load embedding model: {e}")
             raise
     
-    def generate_embedding(self, text: str, language: str = "hr") -> List[float]:
-        """Generate embedding for a single text"""
+    def _cache_key(self, prefixed_text: str) -> str:
+        """Build a content-addressed cache key, partitioned by model/backend and dimension"""
+        digest = hashlib.sha256(prefixed_text.encode("utf-8")).hexdigest()
+        return f"emb:{self.model_id}:{self.dimension}:{digest}"
+    
+    async def _cache_get_many(self, keys: List[str]) -> List[Optional[bytes]]:
+        """Fetch cached embeddings, treating Redis failures as misses"""
+        try:
+            return await get_redis().mget(keys)
+        except Exception as e:
+            logger.warning(f"Embedding cache lookup failed: {e}")
+            return [None] * len(keys)
+    
+    async def _cache_set_many(self, items: List[tuple]):
+        """Store embeddings as float32 bytes with a TTL"""
+        try:
+            async with get_redis().pipeline(transaction=False) as pipe:
+                for key, embedding in items:
+                    pipe.set(key, np.asarray(embedding, dtype=np.float32).tobytes(), ex=settings.EMBEDDING_CACHE_TTL)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Embedding cache write failed: {e}")
+    
+    async def generate_embedding(self, text: str, language: str = "hr") -> np.ndarray:
+        """Generate embedding for a single text as a read-only float32 vector"""
         if not self.model:
             raise RuntimeError("Embedding model not loaded")
         
+        cache_key = (language, text)
+        cached = self._query_cache.get(cache_key)
+        if cached is not None:
+            self._query_cache.move_to_end(cache_key)
+            self.query_cache_hits += 1
+            return cached
+        
+        self.query_cache_misses += 1
+        embedding = await self._encode_query(text, language)
+        
+        self._query_cache[cache_key] = embedding
+        if len(self._query_cache) > settings.QUERY_EMBEDDING_CACHE_SIZE:
+            self._query_cache.popitem(last=False)
+        
+        return embedding
+    
+    async def _encode_query(self, text: str, language: str) -> np.ndarray:
+        """Encode a query via Redis or the model, returning a read-only float32 vector"""
         # Add language-specific prefix for better performance
         if language == "hr":
             prefixed_text = f"query: {text}"
         else:
             prefixed_text = f"query: {text}"
         
+        key = self._cache_key(prefixed_text)
+        cached = (await self._cache_get_many([key]))[0]
+        if cached is not None:
+            return np.frombuffer(cached, dtype=np.float32)
+        
         try:
-            embedding = self.model.encode(prefixed_text, normalize_embeddings=True)
-            return embedding.tolist()
+            embedding = await self._encode_batched(prefixed_text)
         except Exception as e:
             logger.error(f"Failed to generate embedding: {e}")
             raise
+        
+        await self._cache_set_many([(key, embedding)])
+        embedding = np.asarray(embedding, dtype=np.float32)
+        embedding.flags.writeable = False
+        return embedding
     
-    def generate_embeddings_batch(self, texts: List[str], language: str = "hr") -> List[List[float]]:
-        """Generate embeddings for multiple texts"""
+    async def _encode_batched(self, prefixed_text: str) -> np.ndarray:
+        """Queue a single text for the micro-batching worker and wait for its embedding"""
+        loop = asyncio.get_running_loop()
+        
+        # The queue and worker belong to one event loop; rebuild them if the loop changed
+        if self._batch_worker is None or self._batch_worker.done() or self._batch_loop is not loop:
+            self._batch_queue = asyncio.Queue()
+            self._batch_loop = loop
+            self._batch_worker = loop.create_task(self._run_batch_worker(self._batch_queue))
+        
+        future = loop.create_future()
+        await self._batch_queue.put((prefixed_text, future))
+        return await future
+    
+    async def _run_batch_worker(self, queue: asyncio.Queue):
+        """Coalesce queued texts into a single model.encode call per batch window"""
+        loop = asyncio.get_running_loop()
+        wait = settings.EMBED_BATCH_WAIT_MS / 1000
+        
+        while True:
+            batch = [await queue.get()]
+            deadline = loop.time() + wait
+            
+            while len(batch) < settings.EMBED_BATCH_MAX:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            
+            texts = [text for text, _ in batch]
+            try:
+                embeddings = await loop.run_in_executor(
+                    None,
+                    lambda: self.model.encode(texts, batch_size=len(texts), normalize_embeddings=True)
+                )
+            except Exception as e:
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            
+            for (_, future), embedding in zip(batch, embeddings):
+                if not future.done():
+                    future.set_result(embedding)
+    
+    def cache_stats(self) -> Dict[str, int]:
+        """Return hit/miss counters for the in-process query embedding cache"""
+        return {
+            "hits": self.query_cache_hits,
+            "misses": self.query_cache_misses,
+            "size": len(self._query_cache),
+            "max_size": settings.QUERY_EMBEDDING_CACHE_SIZE
+        }
+    
+    async def generate_embeddings_batch(self, texts: List[str], language: str = "hr") -> np.ndarray:
+        """Generate embeddings for multiple texts as an (N, dim) float32 matrix"""
         if not self.model:
             raise RuntimeError("Embedding model not loaded")
         
@@ -52,29 +273,105 @@ class EmbeddingService:
             else:
                 prefixed_texts.append(f"passage: {text}")
         
-        try:
-            embeddings = self.model.encode(prefixed_texts, normalize_embeddings=True)
-            return [emb.tolist() for emb in embeddings]
-        except Exception as e:
-            logger.error(f"Failed to generate batch embeddings: {e}")
-            raise
-    
-    def calculate_similarity(self, embedding1: List[float], embedding2: List[float]) -> float:
-        """Calculate cosine similarity between two embeddings"""
-        try:
-            vec1 = np.array(embedding1)
-            vec2 = np.array(embedding2)
-            
-            # Cosine similarity
-            dot_product = np.dot(vec1, vec2)
-            norm1 = np.linalg.norm(vec1)
-            norm2 = np.linalg.norm(vec2)
-            
-            if norm1 == 0 or norm2 == 0:
-                return 0.0
+        embeddings = np.empty((len(prefixed_texts), self.dimension), dtype=np.float32)
+        if not prefixed_texts:
+            return embeddings
+        
+        keys = [self._cache_key(text) for text in prefixed_texts]
+        cached = await self._cache_get_many(keys)
+        
+        missing = []
+        for i, raw in enumerate(cached):
+            if raw is None:
+                missing.append(i)
+            else:
+                embeddings[i] = np.frombuffer(raw, dtype=np.float32)
+        
+        # Only run the model on cache misses, off the event loop
+        if missing:
+            try:
+                encoded = await asyncio.to_thread(
+                    self.model.encode,
+                    [prefixed_texts[i] for i in missing],
+                    batch_size=settings.EMBEDDING_BATCH_SIZE,
+                    normalize_embeddings=True
+                )
+            except Exception as e:
+                logger.error(f"Failed to generate batch embeddings: {e}")
+                raise
             
-            similarity = dot_product / (norm1 * norm2)
-            return float(similarity)
-        except Exception as e:
-            logger.error(f"Failed to calculate similarity: {e}")
-            return 0.0
\ No newline at end of file
+            embeddings[missing] = encoded
+            await self._cache_set_many([(keys[i], embeddings[i]) for i in missing])
+        
+        return embeddings
+    
+    def calculate_similarity(self, embedding1: np.ndarray, embedding2: np.ndarray) -> float:
+        """Calculate cosine similarity between two normalized embeddings.
+        
+        Embeddings are generated with normalize_embeddings=True, so the dot
+        product is the cosine similarity. Lists are converted once to float32.
+        """
+        vec1 = np.asarray(embedding1, dtype=np.float32)
+        vec2 = np.asarray(embedding2, dtype=np.float32)
+        return float(np.dot(vec1, vec2))
+    
+    def pack_embeddings(self, embeddings: np.ndarray) -> List[bytes]:
+        """Serialize embeddings to raw bytes according to EMBEDDING_STORAGE_DTYPE.
+        
+        int8 rows carry their own float32 scale (max |x| / 127) ahead of the
+        quantized values, so the full int8 range is used for every vector.
+        """
+        matrix = np.asarray(embeddings, dtype=np.float32)
+        
+        if settings.EMBEDDING_STORAGE_DTYPE == "float16":
+            return [row.tobytes() for row in matrix.astype("<f2")]
+        
+        if settings.EMBEDDING_STORAGE_DTYPE == "int8":
+            scales = np.abs(matrix).max(axis=1) / 127
+            scales[scales == 0] = 1
+            quantized = np.clip(np.round(matrix / scales[:, None]), -127, 127).astype(np.int8)
+            return [
+                scale.tobytes() + row.tobytes()
+                for scale, row in zip(scales.astype(_INT8_SCALE_DTYPE), quantized)
+            ]
+        
+        return [row.tobytes() for row in matrix.astype("<f4")]
+    
+    def unpack_embeddings(self, blobs: List[bytes]) -> np.ndarray:
+        """Decode packed embeddings into one contiguous (N, dim) float32 matrix.
+        
+        The storage dtype is recovered from the blob size, so rows written under
+        a different EMBEDDING_STORAGE_DTYPE still decode correctly.
+        """
+        sizes = {len(blob) for blob in blobs}
+        if len(sizes) == 1:
+            return self._decode_blobs(b"".join(blobs), len(blobs), sizes.pop())
+        
+        # Mixed storage dtypes: decode row by row
+        return np.vstack([self._decode_blobs(blob, 1, len(blob)) for blob in blobs])
+    
+    def _decode_blobs(self, data: bytes, rows: int, row_size: int) -> np.ndarray:
+        if row_size == self.dimension + _INT8_SCALE_DTYPE.itemsize:
+            # Scaled int8: per-row scale header, then the quantized values
+            packed = np.frombuffer(data, dtype=np.uint8).reshape(rows, row_size)
+            scales = np.ascontiguousarray(packed[:, :_INT8_SCALE_DTYPE.itemsize]).view(_INT8_SCALE_DTYPE)
+            return packed[:, _INT8_SCALE_DTYPE.itemsize:].view(np.int8).astype(np.float32) * scales
+        if row_size == self.dimension:
+            # Fixed-scale int8 written before per-row scales were stored
+            return np.frombuffer(data, dtype=np.int8).reshape(rows, -1).astype(np.float32) / 127
+        if row_size == self.dimension * 2:
+            return np.frombuffer(data, dtype="<f2").reshape(rows, -1).astype(np.float32)
+        return np.frombuffer(data, dtype="<f4").reshape(rows, -1)
+    
+    def similarities_batch(self, query: np.ndarray, matrix: np.ndarray) -> np.ndarray:
+        """Cosine similarity of one normalized query against an (N, dim) matrix of normalized embeddings"""
+        return matrix @ query
+    
+    def top_k(self, similarities: np.ndarray, k: int) -> np.ndarray:
+        """Indices of the k highest similarities, best first"""
+        if k < len(similarities):
+            # O(N) selection, then sort only the k winners
+            candidates = np.argpartition(similarities, -k)[-k:]
+        else:
+            candidates = np.arange(len(similarities))
+        return candidates[np.argsort(similarities[candidates])[::-1]]
\ No newline at end of file
@@ -1,42 +1,96 @@
-from neo4j import GraphDatabase
-from typing import Dict, Any, List
+from neo4j import AsyncGraphDatabase
+from typing import Dict, Any, List, Optional
+import asyncio
+import functools
 import logging
+from services.cache import get_json, set_json, get_generation, bump_generation, GRAPH_GENERATION
 from config import settings
 
 logger = logging.getLogger(__name__)
 
+# Rows submitted per UNWIND write transaction
+CHUNK_NODE_BATCH_SIZE = 1000
+
+# Schema statements run once per GraphService before its first write
+SCHEMA_STATEMENTS = [
+    "CREATE INDEX IF NOT EXISTS FOR (n:Document) ON (n.id)",
+    "CREATE INDEX IF NOT EXISTS FOR (n:Chunk) ON (n.id)",
+    "CREATE CONSTRAINT IF NOT EXISTS FOR (c:Category) REQUIRE c.name IS UNIQUE"
+]
+
+@functools.lru_cache(maxsize=1)
+def _get_driver():
+    """Process-wide Neo4j driver so every GraphService shares one connection pool"""
+    if not (settings.NEO4J_URI and settings.NEO4J_PASSWORD):
+        logger.warning("Neo4j credentials not provided. Graph functionality will be limited.")
+        return None
+    
+    try:
+        driver = AsyncGraphDatabase.driver(
+            settings.NEO4J_URI,
+            auth=("neo4j", settings.NEO4J_PASSWORD),
+            max_connection_pool_size=settings.NEO4J_POOL_SIZE,
+            connection_acquisition_timeout=30,
+            max_connection_lifetime=3600,
+            keep_alive=True
+        )
+        logger.info("Connected to Neo4j database")
+        return driver
+    except Exception as e:
+        logger.error(f"Failed to connect to Neo4j: {e}")
+        return None
+
 class GraphService:
     def __init__(self):
-        self.driver = None
-        self._connect()
+        self.driver = _get_driver()
+        self._indexes_created = False
     
-    def _connect(self):
-        """Connect to Neo4j database"""
-        try:
-            if settings.NEO4J_URI and settings.NEO4J_PASSWORD:
-                self.driver = GraphDatabase.driver(
-                    settings.NEO4J_URI,
-                    auth=("neo4j", settings.NEO4J_PASSWORD)
-                )
-                logger.info("Connected to Neo4j database")
-            else:
-                logger.warning("Neo4j credentials not provided. Graph functionality will be limited.")
-        except Exception as e:
-            logger.error(f"Failed to connect to Neo4j: {e}")
-    
-    def close(self):
-        """Close Neo4j connection"""
+    async def close(self):
+        """Close the shared Neo4j driver"""
         if self.driver:
-            self.driver.close()
+            await self.driver.close()
+            self.driver = None
+            _get_driver.cache_clear()
+    
+    async def _ensure_indexes(self):
+        """Index node ids and category names so MATCH and MERGE are index lookups.
+        
+        Attempted once: a statement Neo4j rejects (e.g. the constraint over existing
+        duplicate categories) is logged and not re-run before every write.
+        """
+        if self._indexes_created:
+            return
+        self._indexes_created = True
+        
+        for statement in SCHEMA_STATEMENTS:
+            try:
+                async with self.driver.session() as session:
+                    result = await session.run(statement)
+                    await result.consume()
+            except Exception as e:
+                logger.error(f"Failed to apply Neo4j schema statement ({statement}): {e}")
+    
+    @staticmethod
+    async def _write(tx, query: str, **params) -> List[Dict[str, Any]]:
+        result = await tx.run(query, **params)
+        return await result.data()
+    
+    @staticmethod
+    async def _read(tx, query: str, **params) -> List[Dict[str, Any]]:
+        result = await tx.run(query, **params)
+        return await result.data()
     
     async def create_document_node(self, document_id: str, document_data: Dict[str, Any]):
         """Create a document node in the graph"""
         if not self.driver:
             return
         
+        await self._ensure_indexes()
+        
         try:
-            with self.driver.session() as session:
-                session.run(
+            async with self.driver.session() as session:
+                await session.execute_write(
+                    self._write,
                     """
                     MERGE (d:Document {id: $document_id})
                     SET d.filename = $filename,
@@ -51,81 +105,157 @@ class GraphService:
                     upload_date=document_data.get("upload_date")
                 )
                 logger.info(f"Created document node: {document_id}")
+            await bump_generation(document_data.get("category"), GRAPH_GENERATION)
         except Exception as e:
             logger.error(f"Failed to create document node: {e}")
     
     async def create_chunk_nodes(self, document_id: str, chunks: List[Dict[str, Any]]):
-        """Create chunk nodes and relationships"""
+        """Create chunk nodes and relationships, merging on chunk id so replays add nothing.
+        
+        Raises on failure so the caller does not mark the document processed.
+        """
         if not self.driver:
             return
         
+        await self._ensure_indexes()
+        
+        rows = [
+            {
+                "id": chunk["id"],
+                "content": chunk["content"][:500],  # Truncate for graph storage
+                "chunk_index": chunk["chunk_index"],
+                "language": chunk["language"]
+            }
+            for chunk in chunks
+        ]
+        
+        async def ingest_batch(batch: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+            # Sessions are not concurrency-safe, so each batch gets its own
+            async with self.driver.session() as session:
+                return await session.execute_write(
+                    self._write,
+                    """
+                    MATCH (d:Document {id: $document_id})
+                    UNWIND $rows AS row
+                    MERGE (c:Chunk {id: row.id})
+                    SET c.content = row.content,
+                        c.chunk_index = row.chunk_index,
+                        c.language = row.language
+                    MERGE (d)-[:HAS_CHUNK]->(c)
+                    WITH DISTINCT d
+                    RETURN d.category as category
+                    """,
+                    document_id=document_id,
+                    rows=batch
+                )
+        
         try:
-            with self.driver.session() as session:
-                for chunk in chunks:
-                    session.run(
-                        """
-                        MATCH (d:Document {id: $document_id})
-                        CREATE (c:Chunk {
-                            id: $chunk_id,
-                            content: $content,
-                            chunk_index: $chunk_index,
-                            language: $language
-                        })
-                        CREATE (d)-[:HAS_CHUNK]->(c)
-                        """,
-                        document_id=document_id,
-                        chunk_id=chunk["id"],
-                        content=chunk["content"][:500],  # Truncate for graph storage
-                        chunk_index=chunk["chunk_index"],
-                        language=chunk["language"]
-                    )
-                logger.info(f"Created {len(chunks)} chunk nodes for document: {document_id}")
+            # One round-trip per batch instead of one per chunk, batches in flight together
+            batch_records = await asyncio.gather(*[
+                ingest_batch(rows[start:start + CHUNK_NODE_BATCH_SIZE])
+                for start in range(0, len(rows), CHUNK_NODE_BATCH_SIZE)
+            ])
+            # MATCH on a missing document node writes nothing without raising
+            if rows and not all(batch_records):
+                raise RuntimeError(f"Document node not found: {document_id}")
+            logger.info(f"Created {len(chunks)} chunk nodes for document: {document_id}")
         except Exception as e:
             logger.error(f"Failed to create chunk nodes: {e}")
+            raise
+        
+        for category in {record["category"] for records in batch_records for record in records}:
+            await bump_generation(category, GRAPH_GENERATION)
     
-    async def create_category_relationships(self, category: str):
-        """Create category-based relationships"""
+    async def delete_chunk_nodes(self, document_id: str):
+        """Delete a document's chunk nodes, keeping the document node"""
         if not self.driver:
             return
         
         try:
-            with self.driver.session() as session:
-                # Create category node
-                session.run(
+            async with self.driver.session() as session:
+                records = await session.execute_write(
+                    self._write,
                     """
-                    MERGE (cat:Category {name: $category})
+                    MATCH (d:Document {id: $document_id})-[:HAS_CHUNK]->(c:Chunk)
+                    DETACH DELETE c
+                    RETURN DISTINCT d.category as category
                     """,
-                    category=category
+                    document_id=document_id
                 )
-                
-                # Link documents to category
-                session.run(
+            
+            if records:
+                logger.info(f"Deleted stale chunk nodes for document: {document_id}")
+            for record in records:
+                await bump_generation(record["category"], GRAPH_GENERATION)
+        except Exception as e:
+            logger.error(f"Failed to delete chunk nodes: {e}")
+    
+    async def create_category_relationships(self, category: str):
+        """Create category-based relationships"""
+        if not self.driver:
+            return
+        
+        await self._ensure_indexes()
+        
+        try:
+            async with self.driver.session() as session:
+                # Create category node and link its documents in one statement
+                await session.execute_write(
+                    self._write,
                     """
+                    MERGE (cat:Category {name: $category})
+                    WITH cat
                     MATCH (d:Document {category: $category})
-                    MATCH (cat:Category {name: $category})
                     MERGE (cat)-[:CONTAINS]->(d)
                     """,
                     category=category
                 )
                 
                 logger.info(f"Created category relationships for: {category}")
+            await bump_generation(category, GRAPH_GENERATION)
         except Exception as e:
             logger.error(f"Failed to create category relationships: {e}")
     
+    async def _cache_key(self, category: Optional[str], *parts: Any) -> Optional[str]:
+        """Cache key tied to the category's graph generation, so graph writes invalidate it"""
+        generation = await get_generation(category, GRAPH_GENERATION)
+        if generation is None:
+            return None
+        return ":".join(["graph", category or "all", str(generation), *map(str, parts)])
+    
     async def find_similar_documents(self, document_id: str, limit: int = 5) -> List[Dict[str, Any]]:
         """Find similar documents based on graph relationships"""
         if not self.driver:
             return []
         
+        # The source document's category is unknown here, so key on the whole graph
+        cache_key = await self._cache_key(None, "similar", document_id, limit)
+        if cache_key:
+            cached = await get_json(cache_key)
+            if cached is not None:
+                return cached
+        
+        similar_docs = await self._find_similar_documents(document_id, limit)
+        
+        # Empty results may come from a failed query, so only hits are cached
+        if cache_key and similar_docs:
+            await set_json(cache_key, similar_docs, settings.GRAPH_CACHE_TTL)
+        
+        return similar_docs
+    
+    async def _find_similar_documents(self, document_id: str, limit: int) -> List[Dict[str, Any]]:
         try:
-            with self.driver.session() as session:
-                result = session.run(
+            async with self.driver.session() as session:
+                # Walk to same-category documents through the Category node and count
+                # each one's chunks, rather than joining every pair of chunks
+                records = await session.execute_read(
+                    self._read,
                     """
-                    MATCH (d1:Document {id: $document_id})-[:HAS_CHUNK]->(c1:Chunk)
-                    MATCH (d2:Document)-[:HAS_CHUNK]->(c2:Chunk)
-                    WHERE d1 <> d2 AND d1.category = d2.category
+                    MATCH (d1:Document {id: $document_id})<-[:CONTAINS]-(cat:Category)-[:CONTAINS]->(d2:Document)
+                    WHERE d2 <> d1
+                    OPTIONAL MATCH (d2)-[:HAS_CHUNK]->(c:Chunk)
                     RETURN d2.id as document_id, d2.filename as filename, 
-                           count(*) as similarity_score
+                           count(c) as similarity_score
                     ORDER BY similarity_score DESC
                     LIMIT $limit
                     """,
@@ -134,7 +264,7 @@ class GraphService:
                 )
                 
                 similar_docs = []
-                for record in result:
+                for record in records:
                     similar_docs.append({
                         "document_id": record["document_id"],
                         "filename": record["filename"],
@@ -152,10 +282,25 @@ class GraphService:
         if not self.driver:
             return {"nodes": [], "edges": []}
         
+        cache_key = await self._cache_key(category_id, "category_graph")
+        if cache_key:
+            cached = await get_json(cache_key)
+            if cached is not None:
+                return cached
+        
+        graph = await self._get_category_graph(category_id)
+        
+        if cache_key and graph["nodes"]:
+            await set_json(cache_key, graph, settings.GRAPH_CACHE_TTL)
+        
+        return graph
+    
+    async def _get_category_graph(self, category_id: str) -> Dict[str, Any]:
         try:
-            with self.driver.session() as session:
+            async with self.driver.session() as session:
                 # Get nodes
-                nodes_result = session.run(
+                nodes_result = await session.execute_read(
+                    self._read,
                     """
                     MATCH (cat:Category {name: $category})-[:CONTAINS]->(d:Document)
                     OPTIONAL MATCH (d)-[:HAS_CHUNK]->(c:Chunk)
@@ -175,7 +320,8 @@ class GraphService:
                     })
                 
                 # Get relationships
-                edges_result = session.run(
+                edges_result = await session.execute_read(
+                    self._read,
                     """
                     MATCH (cat:Category {name: $category})-[:CONTAINS]->(d1:Document)
                     MATCH (cat)-[:CONTAINS]->(d2:Document)
@@ -209,15 +355,21 @@ class GraphService:
             return
         
         try:
-            with self.driver.session() as session:
-                session.run(
+            async with self.driver.session() as session:
+                records = await session.execute_write(
+                    self._write,
                     """
                     MATCH (d:Document {id: $document_id})
                     OPTIONAL MATCH (d)-[:HAS_CHUNK]->(c:Chunk)
+                    WITH d, c, d.category as category
                     DETACH DELETE d, c
+                    RETURN DISTINCT category
                     """,
                     document_id=document_id
                 )
                 logger.info(f"Deleted document graph: {document_id}")
+            
+            for record in records:
+                await bump_generation(record["category"], GRAPH_GENERATION)
         except Exception as e:
             logger.error(f"Failed to delete document graph: {e}")
\ No newline at end of file
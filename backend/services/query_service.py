@@ -1,21 +1,49 @@
-import json
 import time
-from typing import List, Dict, Any, AsyncGenerator
+import uuid
+import hashlib
+from typing import List, Dict, Any, AsyncGenerator, Optional, Tuple
 import logging
-from groq import Groq
+import numpy as np
+from groq import AsyncGroq
 import asyncio
+import orjson
+from datetime import datetime
+from sqlalchemy import select, insert, func, case
+from sqlalchemy.exc import IntegrityError, DataError
+from sqlalchemy.orm import defer
 
-from database import SessionLocal
+from database import AsyncSessionLocal
 from models import Document, Chunk, QueryHistory
 from services.embedding_service import EmbeddingService
+from services.semantic_cache import SemanticCache
+from services.cache import (
+    get_redis, invalidate, get_json, set_json, get_generation,
+    QUERY_HISTORY_CACHE_KEY, QUERY_HISTORY_BUFFER_KEY, QUERY_HISTORY_DEAD_LETTER_KEY
+)
 from config import settings
 
 logger = logging.getLogger(__name__)
 
+# Rows decoded and scored at a time while streaming candidates for exact search
+EXACT_SEARCH_PARTITION_SIZE = 10000
+
+# Buffered query history rows written per INSERT
+QUERY_HISTORY_FLUSH_BATCH = 100
+
+# Flushes a single history row may fail before it is dead-lettered
+QUERY_HISTORY_MAX_ATTEMPTS = 3
+
+# System prompts
+SYSTEM_PROMPTS = {
+    'hr': """Ti si AI asistent u Zagrebačkoj banci, sve odgovore daješ kao da te klijenti pitaju iz perspektive Zagrebačke banke. Nemoj izmišljati odgovore, odgovore davaj samo iz konteksta koji ti je dan. Također nemoj davati previše informacije učini odgovore što točnijima i sažetijima. Ako odgovor ne možeš naći u danom kontenstu odgovori sa "Nisam mogao pronaći odgovor." """,
+    'en': """You are an AI assistant at Zagrebačka banka, provide all answers as if clients are asking you from the perspective of Zagrebačka banka. Don't make up answers, only provide answers from the given context. Also don't give too much information, make answers as accurate and concise as possible. If you cannot find the answer in the given context, respond with "I could not find the answer." """
+}
+
 class QueryService:
     def __init__(self):
         self.embedding_service = EmbeddingService()
-        self.groq_client = Groq(api_key=settings.GROQ_API_KEY) if settings.GROQ_API_KEY else None
+        self.semantic_cache = SemanticCache(self.embedding_service)
+        self.groq_client = AsyncGroq(api_key=settings.GROQ_API_KEY) if settings.GROQ_API_KEY else None
         
         if not self.groq_client:
             logger.warning("Groq API key not provided. Query functionality will be limited.")
@@ -25,20 +53,29 @@ class QueryService:
         start_time = time.time()
         
         try:
-            # Generate query embedding
-            query_embedding = self.embedding_service.generate_embedding(query, language)
+            # Read once so the answer is cached under the generation it was retrieved from
+            generation = await get_generation(category)
+            
+            cached = None
+            if generation is not None:
+                cached = await self.semantic_cache.lookup(query, language, category, generation)
+            if cached is not None:
+                # The cached answer belongs to whoever asked first; report it as this query
+                response_time = int((time.time() - start_time) * 1000)
+                await self._save_query_history(query, cached["response"], language, response_time)
+                return {**cached, "query": query, "response_time_ms": response_time}
             
             # Retrieve relevant chunks
-            relevant_chunks = await self._retrieve_chunks(query_embedding, language, category)
+            relevant_chunks = await self._retrieve(query, language, category)
             
             # Generate response using Groq
-            response = await self._generate_response(query, relevant_chunks, language)
+            response, generated = await self._generate_response(query, relevant_chunks, language)
             
             # Save query history
             response_time = int((time.time() - start_time) * 1000)
             await self._save_query_history(query, response, language, response_time)
             
-            return {
+            result = {
                 "query": query,
                 "response": response,
                 "sources": [
@@ -55,6 +92,12 @@ class QueryService:
                 "language": language
             }
             
+            # Error and "not configured" messages must not be replayed to later queries
+            if generated and generation is not None:
+                await self.semantic_cache.store(query, language, category, generation, result)
+            
+            return result
+            
         except Exception as e:
             logger.error(f"Failed to process query: {e}")
             raise
@@ -62,11 +105,8 @@ class QueryService:
     async def stream_query(self, query: str, language: str = "hr", category: str = None) -> AsyncGenerator[str, None]:
         """Process query and stream response"""
         try:
-            # Generate query embedding
-            query_embedding = self.embedding_service.generate_embedding(query, language)
-            
             # Retrieve relevant chunks
-            relevant_chunks = await self._retrieve_chunks(query_embedding, language, category)
+            relevant_chunks = await self._retrieve(query, language, category)
             
             # Stream response using Groq
             async for chunk in self._stream_response(query, relevant_chunks, language):
@@ -76,91 +116,178 @@ class QueryService:
             logger.error(f"Failed to stream query: {e}")
             yield f"Error: {str(e)}"
     
-    async def _retrieve_chunks(self, query_embedding: List[float], language: str, category: str = None) -> List[Dict[str, Any]]:
+    async def _retrieve(self, query: str, language: str, category: str = None) -> List[Dict[str, Any]]:
+        """Retrieve relevant chunks for a query, reusing recent results for repeated queries"""
+        cache_key = await self._retrieval_cache_key(query, language, category)
+        if cache_key:
+            cached = await get_json(cache_key)
+            if cached is not None:
+                return cached
+        
+        # Generate query embedding
+        query_embedding = await self.embedding_service.generate_embedding(query, language)
+        
+        relevant_chunks = await self._retrieve_chunks(query_embedding, language, category)
+        
+        # Empty results may come from a failed search, so only hits are cached
+        if cache_key and relevant_chunks:
+            await set_json(cache_key, relevant_chunks, settings.RETRIEVAL_CACHE_TTL)
+        
+        return relevant_chunks
+    
+    async def _retrieval_cache_key(self, query: str, language: str, category: str = None) -> Optional[str]:
+        """Cache key tied to the category's content generation, so ingests invalidate it"""
+        generation = await get_generation(category)
+        if generation is None:
+            return None
+        
+        normalized = " ".join(query.lower().split())
+        digest = hashlib.sha1(f"{language}|{category}|{normalized}".encode("utf-8")).hexdigest()
+        return f"retrieval:{category or 'all'}:{generation}:{digest}"
+    
+    async def _retrieve_chunks(self, query_embedding: np.ndarray, language: str, category: str = None) -> List[Dict[str, Any]]:
         """Retrieve relevant chunks using vector similarity"""
         try:
-            db = SessionLocal()
-            
-            # Build query
-            query_builder = db.query(Chunk, Document).join(Document)
+            async with AsyncSessionLocal() as db:
+                if settings.VECTOR_SEARCH_MODE == "exact":
+                    results = await self._exact_search(db, query_embedding, language, category)
+                else:
+                    results = await self._ann_search(db, query_embedding, language, category)
             
-            # Filter by language
-            query_builder = query_builder.filter(Chunk.language == language)
-            
-            # Filter by category if specified
-            if category:
-                query_builder = query_builder.filter(Document.category == category)
-            
-            # Get all chunks (in production, use vector similarity search)
-            results = query_builder.all()
-            
-            # Calculate similarities (simplified version)
             chunk_similarities = []
-            for chunk, document in results:
-                if chunk.embedding:
-                    try:
-                        # Parse embedding from string (in production, use proper vector operations)
-                        chunk_embedding = json.loads(chunk.embedding.replace("'", '"'))
-                        similarity = self.embedding_service.calculate_similarity(query_embedding, chunk_embedding)
-                        
-                        if similarity >= settings.SIMILARITY_THRESHOLD:
-                            chunk_similarities.append({
-                                "chunk_id": str(chunk.id),
-                                "document_id": str(document.id),
-                                "filename": document.filename,
-                                "content": chunk.content,
-                                "chunk_index": chunk.chunk_index,
-                                "similarity": similarity,
-                                "metadata": chunk.chunk_metadata
-                            })
-                    except Exception as e:
-                        logger.warning(f"Failed to parse embedding for chunk {chunk.id}: {e}")
-                        continue
-            
-            # Sort by similarity and return top chunks
-            chunk_similarities.sort(key=lambda x: x["similarity"], reverse=True)
-            db.close()
-            
-            return chunk_similarities[:settings.MAX_CHUNKS_PER_QUERY]
+            for chunk, document, similarity in results:
+                if similarity >= settings.SIMILARITY_THRESHOLD:
+                    chunk_similarities.append({
+                        "chunk_id": str(chunk.id),
+                        "document_id": str(document.id),
+                        "filename": document.filename,
+                        "content": chunk.content,
+                        "chunk_index": chunk.chunk_index,
+                        "similarity": similarity,
+                        "metadata": chunk.chunk_metadata
+                    })
+            
+            return chunk_similarities
             
         except Exception as e:
             logger.error(f"Failed to retrieve chunks: {e}")
             return []
     
-    async def _generate_response(self, query: str, chunks: List[Dict[str, Any]], language: str) -> str:
-        """Generate response using Groq"""
+    async def _ann_search(self, db, query_embedding: np.ndarray, language: str, category: str = None) -> List[Tuple[Chunk, Document, float]]:
+        """Top chunks via the pgvector HNSW index"""
+        # Cosine distance (<=>) is served by the HNSW index on chunks.embedding
+        distance = Chunk.embedding.cosine_distance(query_embedding).label("distance")
+        
+        # The language/category filters are applied after the index scan, so widen the
+        # candidate list to still find MAX_CHUNKS_PER_QUERY matches
+        # (set_config rather than SET, which cannot take a bind parameter)
+        await db.execute(select(func.set_config("hnsw.ef_search", str(settings.HNSW_EF_SEARCH), True)))
+        
+        # Build query, leaving the vectors themselves in the database
+        stmt = (
+            select(Chunk, Document, distance)
+            .join(Document)
+            .options(defer(Chunk.embedding), defer(Chunk.embedding_quantized))
+        )
+        
+        # Filter by language
+        stmt = stmt.where(Chunk.language == language)
+        
+        # Filter by category if specified
+        if category:
+            stmt = stmt.where(Document.category == category)
+        
+        # Let Postgres return the nearest chunks
+        results = await db.execute(stmt.order_by(distance).limit(settings.MAX_CHUNKS_PER_QUERY))
+        return [(chunk, document, 1 - float(chunk_distance)) for chunk, document, chunk_distance in results]
+    
+    async def _exact_search(self, db, query_embedding: np.ndarray, language: str, category: str = None) -> List[Tuple[Chunk, Document, float]]:
+        """Top chunks by brute-force scoring of every candidate, one matrix multiply per partition.
+        
+        Unlike HNSW this never misses neighbours when the language/category
+        filter removes most of the index, at the cost of reading every vector.
+        """
+        k = settings.MAX_CHUNKS_PER_QUERY
+        query_vector = np.asarray(query_embedding, dtype=np.float32)
+        
+        # Fetch only ids and packed vectors for scoring; the pgvector column is read
+        # only for chunks stored before the packed copy existed
+        fallback_vector = case((Chunk.embedding_quantized.is_(None), Chunk.embedding))
+        
+        stmt = select(Chunk.id, Chunk.embedding_quantized, fallback_vector).join(Document)
+        stmt = stmt.where(Chunk.language == language, Chunk.embedding.isnot(None))
+        if category:
+            stmt = stmt.where(Document.category == category)
+        
+        # Stream candidates through a server-side cursor, keeping only each partition's top k
+        candidate_ids = []
+        candidate_similarities = []
+        result = await db.stream(stmt.execution_options(yield_per=EXACT_SEARCH_PARTITION_SIZE))
+        async for rows in result.partitions():
+            blobs = [
+                blob if blob is not None else np.asarray(vector, dtype=np.float32).tobytes()
+                for _, blob, vector in rows
+            ]
+            matrix = self.embedding_service.unpack_embeddings(blobs)
+            similarities = self.embedding_service.similarities_batch(query_vector, matrix)
+            
+            for i in self.embedding_service.top_k(similarities, k):
+                candidate_ids.append(rows[i][0])
+                candidate_similarities.append(float(similarities[i]))
+        
+        if not candidate_ids:
+            return []
+        
+        top = self.embedding_service.top_k(np.asarray(candidate_similarities), k)
+        
+        # Load full rows only for the winners
+        top_ids = [candidate_ids[i] for i in top]
+        loaded_rows = await db.execute(
+            select(Chunk, Document)
+            .join(Document)
+            .options(defer(Chunk.embedding), defer(Chunk.embedding_quantized))
+            .where(Chunk.id.in_(top_ids))
+        )
+        loaded = {chunk.id: (chunk, document) for chunk, document in loaded_rows}
+        
+        return [
+            (*loaded[candidate_ids[i]], candidate_similarities[i])
+            for i in top
+            if candidate_ids[i] in loaded
+        ]
+    
+    def _build_messages(self, query: str, chunks: List[Dict[str, Any]], language: str) -> List[Dict[str, str]]:
+        """Build the Groq chat messages for a query and its retrieved chunks"""
+        # Prepare context from chunks
+        context = "\n\n".join(
+            f"Dokument: {chunk['filename']}\nSadržaj: {chunk['content']}"
+            for chunk in chunks
+        )
+        
+        return [
+            {"role": "system", "content": SYSTEM_PROMPTS.get(language, SYSTEM_PROMPTS['hr'])},
+            {"role": "user", "content": f"Kontekst:\n{context}\n\nPitanje: {query}"}
+        ]
+    
+    async def _generate_response(self, query: str, chunks: List[Dict[str, Any]], language: str) -> Tuple[str, bool]:
+        """Generate response using Groq, returning the text and whether the model produced it"""
         if not self.groq_client:
-            return "Groq API not configured. Please provide a valid API key."
+            return "Groq API not configured. Please provide a valid API key.", False
         
         try:
-            # Prepare context from chunks
-            context = "\n\n".join([
-                f"Dokument: {chunk['filename']}\nSadržaj: {chunk['content']}"
-                for chunk in chunks
-            ])
-            
-            # System prompts
-            system_prompts = {
-                'hr': """Ti si AI asistent u Zagrebačkoj banci, sve odgovore daješ kao da te klijenti pitaju iz perspektive Zagrebačke banke. Nemoj izmišljati odgovore, odgovore davaj samo iz konteksta koji ti je dan. Također nemoj davati previše informacije učini odgovore što točnijima i sažetijima. Ako odgovor ne možeš naći u danom kontenstu odgovori sa "Nisam mogao pronaći odgovor." """,
-                'en': """You are an AI assistant at Zagrebačka banka, provide all answers as if clients are asking you from the perspective of Zagrebačka banka. Don't make up answers, only provide answers from the given context. Also don't give too much information, make answers as accurate and concise as possible. If you cannot find the answer in the given context, respond with "I could not find the answer." """
-            }
-            
             # Generate response
-            response = self.groq_client.chat.completions.create(
+            response = await self.groq_client.chat.completions.create(
                 model="llama3-8b-8192",
-                messages=[
-                    {"role": "system", "content": system_prompts.get(language, system_prompts['hr'])},
-                    {"role": "user", "content": f"Kontekst:\n{context}\n\nPitanje: {query}"}
-                ],
+                messages=self._build_messages(query, chunks, language),
                 temperature=0.7,
                 max_tokens=2000
             )
             
-            return response.choices[0].message.content
+            return response.choices[0].message.content, True
             
         except Exception as e:
             logger.error(f"Failed to generate response with Groq: {e}")
-            return f"Greška pri generiranju odgovora: {str(e)}"
+            return f"Greška pri generiranju odgovora: {str(e)}", False
     
     async def _stream_response(self, query: str, chunks: List[Dict[str, Any]], language: str) -> AsyncGenerator[str, None]:
         """Stream response using Groq"""
@@ -169,31 +296,16 @@ class QueryService:
             return
         
         try:
-            # Prepare context from chunks
-            context = "\n\n".join([
-                f"Dokument: {chunk['filename']}\nSadržaj: {chunk['content']}"
-                for chunk in chunks
-            ])
-            
-            # System prompts
-            system_prompts = {
-                'hr': """Ti si AI asistent u Zagrebačkoj banci, sve odgovore daješ kao da te klijenti pitaju iz perspektive Zagrebačke banke. Nemoj izmišljati odgovore, odgovore davaj samo iz konteksta koji ti je dan. Također nemoj davati previše informacije učini odgovore što točnijima i sažetijima. Ako odgovor ne možeš naći u danom kontenstu odgovori sa "Nisam mogao pronaći odgovor." """,
-                'en': """You are an AI assistant at Zagrebačka banka, provide all answers as if clients are asking you from the perspective of Zagrebačka banka. Don't make up answers, only provide answers from the given context. Also don't give too much information, make answers as accurate and concise as possible. If you cannot find the answer in the given context, respond with "I could not find the answer." """
-            }
-            
             # Stream response
-            stream = self.groq_client.chat.completions.create(
+            stream = await self.groq_client.chat.completions.create(
                 model="llama3-8b-8192",
-                messages=[
-                    {"role": "system", "content": system_prompts.get(language, system_prompts['hr'])},
-                    {"role": "user", "content": f"Kontekst:\n{context}\n\nPitanje: {query}"}
-                ],
+                messages=self._build_messages(query, chunks, language),
                 temperature=0.7,
                 max_tokens=2000,
                 stream=True
             )
             
-            for chunk in stream:
+            async for chunk in stream:
                 if chunk.choices[0].delta.content is not None:
                     yield chunk.choices[0].delta.content
                     
@@ -202,20 +314,102 @@ class QueryService:
             yield f"Greška pri generiranju odgovora: {str(e)}"
     
     async def _save_query_history(self, query: str, response: str, language: str, response_time: int):
-        """Save query to history"""
+        """Buffer a query for history; flush_query_history writes it to Postgres"""
         try:
-            db = SessionLocal()
-            
-            history = QueryHistory(
-                query_text=query,
-                response_text=response,
-                language=language,
-                response_time_ms=response_time
-            )
-            
-            db.add(history)
-            db.commit()
-            db.close()
+            await get_redis().rpush(QUERY_HISTORY_BUFFER_KEY, orjson.dumps({
+                "id": str(uuid.uuid4()),
+                "query_text": query,
+                "response_text": response,
+                "language": (language or settings.DEFAULT_LANGUAGE)[:2],  # query_history.language is VARCHAR(2)
+                "response_time_ms": response_time,
+                "created_at": datetime.utcnow().isoformat()
+            }))
             
         except Exception as e:
-            logger.error(f"Failed to save query history: {e}")
\ No newline at end of file
+            logger.error(f"Failed to save query history: {e}")
+
+async def flush_query_history() -> int:
+    """Move buffered query history from Redis into Postgres in batches"""
+    client = get_redis()
+    flushed = 0
+    
+    while True:
+        # Take the oldest batch atomically; RPUSHes in between land after it
+        async with client.pipeline(transaction=True) as pipe:
+            pipe.lrange(QUERY_HISTORY_BUFFER_KEY, 0, QUERY_HISTORY_FLUSH_BATCH - 1)
+            pipe.ltrim(QUERY_HISTORY_BUFFER_KEY, QUERY_HISTORY_FLUSH_BATCH, -1)
+            entries, _ = await pipe.execute()
+        
+        if not entries:
+            break
+        
+        payloads = []
+        for entry in entries:
+            try:
+                payloads.append(orjson.loads(entry))
+            except Exception as e:
+                logger.error(f"Dead-lettering unreadable query history entry: {e}")
+                await client.rpush(QUERY_HISTORY_DEAD_LETTER_KEY, entry)
+        
+        try:
+            await _insert_query_history([_history_row(payload) for payload in payloads])
+            flushed += len(payloads)
+            continue
+        except Exception as e:
+            if not _is_bad_row_error(e):
+                await _defer_query_history(client, payloads, e)
+                break
+            logger.warning(f"Batch query history insert failed, retrying rows individually: {e}")
+        
+        # Isolate the rows that cannot be inserted so they do not hold back the rest
+        failed = False
+        for i, payload in enumerate(payloads):
+            try:
+                await _insert_query_history([_history_row(payload)])
+                flushed += 1
+            except Exception as e:
+                failed = True
+                if not _is_bad_row_error(e):
+                    await _defer_query_history(client, payloads[i:], e)
+                    break
+                payload["attempts"] = payload.get("attempts", 0) + 1
+                if payload["attempts"] >= QUERY_HISTORY_MAX_ATTEMPTS:
+                    logger.error(f"Dead-lettering query history row {payload.get('id')}: {e}")
+                    await client.rpush(QUERY_HISTORY_DEAD_LETTER_KEY, orjson.dumps(payload))
+                else:
+                    # Retried on a later flush, behind the rows queued meanwhile
+                    await client.rpush(QUERY_HISTORY_BUFFER_KEY, orjson.dumps(payload))
+        
+        if failed:
+            break
+    
+    if flushed:
+        await invalidate(QUERY_HISTORY_CACHE_KEY)
+    
+    return flushed
+
+def _is_bad_row_error(error: Exception) -> bool:
+    """Whether an insert failed because of the row itself rather than the database"""
+    return isinstance(error, (IntegrityError, DataError, KeyError, TypeError, ValueError))
+
+async def _defer_query_history(client, payloads: List[Dict[str, Any]], error: Exception):
+    """Put rows back at the head of the buffer, unchanged, for the next flush"""
+    logger.error(f"Query history flush deferred, database unavailable: {error}")
+    if payloads:
+        await client.lpush(QUERY_HISTORY_BUFFER_KEY, *reversed([orjson.dumps(payload) for payload in payloads]))
+
+def _history_row(payload: Dict[str, Any]) -> Dict[str, Any]:
+    """QueryHistory insert values from a buffered payload"""
+    return {
+        "id": uuid.UUID(payload["id"]),
+        "query_text": payload["query_text"],
+        "response_text": payload["response_text"],
+        "language": payload["language"],
+        "response_time_ms": payload["response_time_ms"],
+        "created_at": datetime.fromisoformat(payload["created_at"])
+    }
+
+async def _insert_query_history(rows: List[Dict[str, Any]]):
+    async with AsyncSessionLocal() as db:
+        await db.execute(insert(QueryHistory), rows)
+        await db.commit()
\ No newline at end of file
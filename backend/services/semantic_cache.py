@@ -0,0 +1,132 @@
+import json
+import re
+import uuid
+from typing import Dict, Any, Optional
+import logging
+from redis.exceptions import ResponseError
+from redis.commands.search.field import VectorField, TagField
+from redis.commands.search.indexDefinition import IndexDefinition, IndexType
+from redis.commands.search.query import Query
+
+from services.embedding_service import EmbeddingService
+from services.cache import get_redis
+from config import settings
+
+logger = logging.getLogger(__name__)
+
+# Versioned so a schema change builds a fresh index instead of reusing the old one
+INDEX_NAME = "semcache_v2_idx"
+KEY_PREFIX = "semcache:v2:"
+
+# Characters that must be escaped inside a RediSearch TAG filter
+_TAG_ESCAPE = re.compile(r"([^A-Za-z0-9_])")
+
+class SemanticCache:
+    """Approximate-match response cache backed by a RediSearch HNSW index"""
+    
+    def __init__(self, embedding_service: EmbeddingService):
+        self.embedding_service = embedding_service
+        self.enabled = False
+    
+    async def create_index(self):
+        """Create the vector index if it does not exist yet"""
+        try:
+            try:
+                await get_redis().ft(INDEX_NAME).info()
+            except ResponseError:
+                await get_redis().ft(INDEX_NAME).create_index(
+                    [
+                        VectorField(
+                            "embedding",
+                            "HNSW",
+                            {
+                                "TYPE": "FLOAT32",
+                                "DIM": self.embedding_service.dimension,
+                                "DISTANCE_METRIC": "COSINE"
+                            }
+                        ),
+                        TagField("language"),
+                        TagField("category"),
+                        TagField("generation")
+                    ],
+                    definition=IndexDefinition(prefix=[KEY_PREFIX], index_type=IndexType.HASH)
+                )
+                logger.info(f"Created semantic cache index: {INDEX_NAME}")
+            self.enabled = True
+        except Exception as e:
+            logger.warning(f"Semantic cache disabled (RediSearch unavailable): {e}")
+    
+    async def lookup(self, query: str, language: str, category: str, generation: int) -> Optional[Dict[str, Any]]:
+        """Return a cached response for a semantically equivalent query, if any.
+        
+        Only responses stored under the category's current content generation match,
+        so ingests and deletes retire older answers.
+        """
+        if not self.enabled:
+            return None
+        
+        try:
+            vector = await self._query_vector(query, language)
+            search = (
+                Query(
+                    f"(@language:{{{self._escape(language)}}}"
+                    f" @category:{{{self._escape(self._category_tag(category))}}}"
+                    f" @generation:{{{generation}}})"
+                    f"=>[KNN 1 @embedding $vec AS score]"
+                )
+                .return_fields("response", "score")
+                .dialect(2)
+            )
+            result = await get_redis().ft(INDEX_NAME).search(search, query_params={"vec": vector})
+            
+            if not result.docs:
+                return None
+            
+            # COSINE distance in RediSearch is 1 - cosine similarity
+            match = result.docs[0]
+            similarity = 1 - float(match.score)
+            if similarity < settings.SEMANTIC_CACHE_THRESHOLD:
+                return None
+            
+            logger.info(f"Semantic cache hit (similarity {similarity:.3f})")
+            return json.loads(match.response)
+        
+        except Exception as e:
+            logger.warning(f"Semantic cache lookup failed: {e}")
+            return None
+    
+    async def store(self, query: str, language: str, category: str, generation: int, response: Dict[str, Any]):
+        """Store a query response under the content generation it was retrieved from"""
+        if not self.enabled:
+            return
+        
+        # Answers produced without any retrieved context are not worth replaying
+        if not response.get("sources"):
+            return
+        
+        try:
+            vector = await self._query_vector(query, language)
+            key = f"{KEY_PREFIX}{uuid.uuid4()}"
+            async with get_redis().pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping={
+                    "embedding": vector,
+                    "response": json.dumps(response, ensure_ascii=False),
+                    "language": language,
+                    "category": self._category_tag(category),
+                    "generation": str(generation)
+                })
+                pipe.expire(key, settings.SEMANTIC_CACHE_TTL)
+                await pipe.execute()
+        except Exception as e:
+            logger.warning(f"Semantic cache store failed: {e}")
+    
+    async def _query_vector(self, query: str, language: str) -> bytes:
+        """Embed the query as float32 bytes for the vector index"""
+        embedding = await self.embedding_service.generate_embedding(query, language)
+        return embedding.tobytes()
+    
+    def _category_tag(self, category: Optional[str]) -> str:
+        return category or "all"
+    
+    def _escape(self, value: str) -> str:
+        return _TAG_ESCAPE.sub(r"\\\1", value)
@@ -1,20 +1,45 @@
 import os
-from typing import List, Dict, Any
+import re
+import itertools
+from typing import List, Dict, Any, Optional, Tuple
 import logging
+import numpy as np
 from langdetect import detect
-import PyPDF2
+import pypdfium2 as pdfium
 from docx import Document as DocxDocument
 import markdown
 from config import settings
 
 logger = logging.getLogger(__name__)
 
+_SENTENCE_SPLIT = re.compile(r'[.!?]+')
+_HTML_TAG = re.compile(r'<[^<]+?>')
+
+# Leading characters of extracted text used for language detection
+LANGUAGE_SAMPLE_CHARS = 2000
+
+def extract_and_chunk(file_path: str, language: Optional[str]) -> Tuple[str, List[Dict[str, Any]]]:
+    """Extract and split a document, ready to embed.
+    
+    Top-level so it can run in a ProcessPoolExecutor worker. When language
+    is None it is detected from the extracted text. Returns (language, chunks).
+    """
+    processor = TextProcessor()
+    text = processor.extract_text_sync(file_path)
+    if language is None:
+        language = processor.detect_language(text[:LANGUAGE_SAMPLE_CHARS])
+    return language, processor.split_text(text, language)
+
 class TextProcessor:
     def __init__(self):
         pass
     
     async def extract_text(self, file_path: str) -> str:
         """Extract text from various file formats"""
+        return self.extract_text_sync(file_path)
+    
+    def extract_text_sync(self, file_path: str) -> str:
+        """Extract text from various file formats, blocking the caller"""
         try:
             file_extension = os.path.splitext(file_path)[1].lower()
             
@@ -35,24 +60,23 @@ class TextProcessor:
     
     def _extract_from_pdf(self, file_path: str) -> str:
         """Extract text from PDF file"""
-        text = ""
         try:
-            with open(file_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                for page in pdf_reader.pages:
-                    text += page.extract_text() + "\n"
+            pdf = pdfium.PdfDocument(file_path)
+            try:
+                # Collect pages and join once instead of growing one string
+                pages = [pdf[i].get_textpage().get_text_range() for i in range(len(pdf))]
+            finally:
+                pdf.close()
         except Exception as e:
             logger.error(f"Failed to extract text from PDF {file_path}: {e}")
             raise
-        return text.strip()
+        return "\n".join(pages).strip()
     
     def _extract_from_docx(self, file_path: str) -> str:
         """Extract text from DOCX file"""
         try:
             doc = DocxDocument(file_path)
-            text = ""
-            for paragraph in doc.paragraphs:
-                text += paragraph.text + "\n"
+            text = "\n".join(paragraph.text for paragraph in doc.paragraphs)
         except Exception as e:
             logger.error(f"Failed to extract text from DOCX {file_path}: {e}")
             raise
@@ -81,8 +105,7 @@ class TextProcessor:
             # Convert markdown to plain text
             html = markdown.markdown(md_content)
             # Simple HTML tag removal (for basic conversion)
-            import re
-            text = re.sub('<[^<]+?>', '', html)
+            text = _HTML_TAG.sub('', html)
         except Exception as e:
             logger.error(f"Failed to extract text from Markdown {file_path}: {e}")
             raise
@@ -91,49 +114,41 @@ class TextProcessor:
     def split_text(self, text: str, language: str = "hr") -> List[Dict[str, Any]]:
         """Split text into chunks with overlap"""
         try:
-            # Simple sentence-based splitting for now
-            sentences = self._split_into_sentences(text)
-            chunks = []
+            # Simple sentence-based splitting for now, tokenized into words once
+            sentence_words = [sentence.split() for sentence in self._split_into_sentences(text)]
+            if not sentence_words:
+                return []
             
-            current_chunk = ""
-            current_length = 0
-            chunk_index = 0
+            words = list(itertools.chain.from_iterable(sentence_words))
+            # sentence_ends[i] is the word offset just past sentence i
+            sentence_ends = np.cumsum([len(sentence) for sentence in sentence_words])
+            sentence_count = len(sentence_ends)
             
-            for sentence in sentences:
-                sentence_length = len(sentence.split())
-                
-                # If adding this sentence would exceed chunk size, save current chunk
-                if current_length + sentence_length > settings.CHUNK_SIZE and current_chunk:
-                    chunks.append({
-                        "content": current_chunk.strip(),
-                        "metadata": {
-                            "chunk_index": chunk_index,
-                            "word_count": current_length,
-                            "language": language
-                        }
-                    })
-                    
-                    # Start new chunk with overlap
-                    overlap_sentences = self._get_overlap_sentences(current_chunk, settings.CHUNK_OVERLAP)
-                    current_chunk = overlap_sentences + " " + sentence
-                    current_length = len(current_chunk.split())
-                    chunk_index += 1
-                else:
-                    current_chunk += " " + sentence if current_chunk else sentence
-                    current_length += sentence_length
+            chunks = []
+            start = 0  # First word of the current chunk
+            next_sentence = 1  # Every chunk takes at least one new sentence
             
-            # Add the last chunk
-            if current_chunk.strip():
+            while True:
+                # Greedily take the following sentences while the chunk stays within CHUNK_SIZE words
+                last = max(int(np.searchsorted(sentence_ends, start + settings.CHUNK_SIZE, side="right")), next_sentence)
+                end = int(sentence_ends[last - 1])
+                
                 chunks.append({
-                    "content": current_chunk.strip(),
+                    "content": " ".join(words[start:end]),
                     "metadata": {
-                        "chunk_index": chunk_index,
-                        "word_count": current_length,
+                        "chunk_index": len(chunks),
+                        "word_count": end - start,
                         "language": language
                     }
                 })
-            
-            return chunks
+                
+                if last >= sentence_count:
+                    return chunks
+                
+                # Start new chunk with the last CHUNK_OVERLAP words of this one
+                if end - start > settings.CHUNK_OVERLAP:
+                    start = end - settings.CHUNK_OVERLAP
+                next_sentence = last + 1
             
         except Exception as e:
             logger.error(f"Failed to split text: {e}")
@@ -142,35 +157,14 @@ class TextProcessor:
     def _split_into_sentences(self, text: str) -> List[str]:
         """Split text into sentences"""
         # Simple sentence splitting (can be improved with spaCy)
-        import re
-        sentences = re.split(r'[.!?]+', text)
+        sentences = _SENTENCE_SPLIT.split(text)
         return [s.strip() for s in sentences if s.strip()]
     
-    def _get_overlap_sentences(self, text: str, overlap_words: int) -> str:
-        """Get last N words for overlap"""
-        words = text.split()
-        if len(words) <= overlap_words:
-            return text
-        return " ".join(words[-overlap_words:])
-    
-    def detect_language(self, file_path: str) -> str:
-        """Detect language of the document"""
+    def detect_language(self, text_sample: str) -> str:
+        """Detect language from a sample of already-extracted document text"""
         try:
-            # Extract a sample of text for language detection
-            text = ""
-            file_extension = os.path.splitext(file_path)[1].lower()
-            
-            if file_extension == '.txt':
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    text = f.read()[:1000]  # First 1000 characters
-            elif file_extension == '.pdf':
-                with open(file_path, 'rb') as file:
-                    pdf_reader = PyPDF2.PdfReader(file)
-                    if len(pdf_reader.pages) > 0:
-                        text = pdf_reader.pages[0].extract_text()[:1000]
-            
-            if text.strip():
-                detected_lang = detect(text)
+            if text_sample.strip():
+                detected_lang = detect(text_sample)
                 # Map detected language to supported languages
                 if detected_lang in ['hr', 'sr', 'bs']:  # Croatian, Serbian, Bosnian
                     return 'hr'
@@ -180,6 +174,6 @@ class TextProcessor:
                     return settings.DEFAULT_LANGUAGE
             
         except Exception as e:
-            logger.warning(f"Failed to detect language for {file_path}: {e}")
+            logger.warning(f"Failed to detect language: {e}")
         
         return settings.DEFAULT_LANGUAGE
\ No newline at end of file
@@ -1,7 +1,12 @@
 from celery import Celery
+from celery.signals import worker_process_init, worker_process_shutdown, worker_shutdown
 import os
+import asyncio
+import logging
 from config import settings
 
+logger = logging.getLogger(__name__)
+
 # Create Celery app
 celery_app = Celery(
     "ragapp",
@@ -22,23 +27,89 @@ celery_app.conf.update(
     task_soft_time_limit=25 * 60,  # 25 minutes
     worker_prefetch_multiplier=1,
     worker_max_tasks_per_child=1000,
+    # Frequent housekeeping runs on its own cheap worker so it neither spends the
+    # ingestion workers' recycle budget nor triggers model reloads there
+    task_routes={
+        "tasks.flush_query_history_task": {"queue": "maintenance"},
+    },
+    beat_schedule={
+        "flush-query-history": {
+            "task": "tasks.flush_query_history_task",
+            "schedule": settings.QUERY_HISTORY_FLUSH_INTERVAL,
+        },
+    },
 )
 
+# Built once per worker process so models and connection pools are reused across tasks
+_DOC_SERVICE = None
+
+def _get_doc_service():
+    """Return the process-wide DocumentService, creating it on first use"""
+    global _DOC_SERVICE
+    if _DOC_SERVICE is None:
+        from services.document_service import DocumentService
+        _DOC_SERVICE = DocumentService()
+    return _DOC_SERVICE
+
+# One event loop per worker process: asyncpg, Redis and Neo4j connection pools are
+# bound to the loop that opened them and would be lost with a loop per task
+_LOOP = None
+
+def _extract_document(job):
+    """Extraction pool worker: extract and split one document without raising across the pool"""
+    from services.text_processor import extract_and_chunk
+    
+    document_id, file_path, language = job
+    try:
+        return document_id, extract_and_chunk(file_path, language), None
+    except Exception as e:
+        return document_id, None, str(e)
+
+def _run(coro):
+    """Run a coroutine on the worker's persistent event loop"""
+    global _LOOP
+    if _LOOP is None:
+        _LOOP = asyncio.new_event_loop()
+        asyncio.set_event_loop(_LOOP)
+    return _LOOP.run_until_complete(coro)
+
+@worker_process_init.connect
+def init_worker_process(**kwargs):
+    """Load the model and open connection pools after the worker forks, before the first task"""
+    from database import async_engine
+    
+    # Connections inherited from the parent are shared with it and bound to its loop
+    async_engine.sync_engine.dispose(close=False)
+    if settings.WORKER_PRELOAD_MODEL:
+        _get_doc_service()
+
+@worker_process_shutdown.connect
+@worker_shutdown.connect
+def shutdown_worker_process(**kwargs):
+    """Release loop-bound connection pools and close the event loop"""
+    global _LOOP
+    if _LOOP is None or _LOOP.is_closed():
+        return
+    
+    from database import async_engine
+    from services.graph_service import GraphService
+    
+    try:
+        _run(GraphService().close())
+        _run(async_engine.dispose())
+    except Exception as e:
+        logger.warning(f"Failed to close worker connections: {e}")
+    finally:
+        _LOOP.close()
+        _LOOP = None
+
 @celery_app.task(bind=True)
 def process_document_task(self, document_id: str):
     """Celery task to process document"""
     try:
-        from services.document_service import DocumentService
-        import asyncio
-        
-        # Create document service
-        doc_service = DocumentService()
-        
-        # Process document
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(doc_service._process_document(document_id))
-        loop.close()
+        # Process document; failures are logged and reported as False, retry those
+        if not _run(_get_doc_service()._process_document(document_id)):
+            raise RuntimeError(f"Failed to process document {document_id}")
         
         return {"status": "success", "document_id": document_id}
         
@@ -50,17 +121,9 @@ def process_document_task(self, document_id: str):
 def scan_documents_task(self):
     """Celery task to scan documents folder"""
     try:
-        from services.document_service import DocumentService
-        import asyncio
-        
-        # Create document service
-        doc_service = DocumentService()
-        
-        # Scan documents
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        result = loop.run_until_complete(doc_service.scan_documents_folder())
-        loop.close()
+        # Scan documents and wait for their processing: tasks left pending on the
+        # worker's loop would only advance whenever a later task happens to run it
+        result = _run(_get_doc_service().scan_documents_folder(wait=True))
         
         return result
         
@@ -74,24 +137,51 @@ def update_embeddings_task():
     try:
         from database import SessionLocal
         from models import Document
-        import asyncio
+        from billiard.pool import Pool
         
-        db = SessionLocal()
-        documents = db.query(Document).filter(Document.last_processed.is_(None)).all()
+        with SessionLocal() as db:
+            documents = [
+                # Language None: detect it from the extracted text
+                (str(document_id), file_path, None if (doc_metadata or {}).get("detect_language") else language)
+                for document_id, file_path, language, doc_metadata in db.query(
+                    Document.id, Document.file_path, Document.language, Document.doc_metadata
+                ).filter(Document.last_processed.is_(None)).all()
+            ]
         
-        from services.document_service import DocumentService
-        doc_service = DocumentService()
+        if not documents:
+            return {"status": "success", "processed": 0}
+        
+        # Extract and split across cores; each document is embedded as soon as its
+        # chunks are ready. billiard's pool, unlike the stdlib one, may be started from
+        # a (daemonic) prefork worker process.
+        processed = 0
+        pool = Pool(processes=min(len(documents), os.cpu_count() or 1))
+        try:
+            for document_id, extracted, error in pool.imap_unordered(_extract_document, documents):
+                if error is not None:
+                    logger.error(f"Failed to extract document {document_id}: {error}")
+                    continue
+                language, chunks = extracted
+                if _run(_get_doc_service()._process_document(document_id, chunks, language)):
+                    processed += 1
+        finally:
+            pool.close()
+            pool.join()
         
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        return {"status": "success", "processed": processed}
         
-        for document in documents:
-            loop.run_until_complete(doc_service._process_document(str(document.id)))
+    except Exception as e:
+        return {"status": "error", "error": str(e)}
+
+@celery_app.task(ignore_result=True)
+def flush_query_history_task():
+    """Celery beat task to write buffered query history to the database"""
+    try:
+        from services.query_service import flush_query_history
         
-        loop.close()
-        db.close()
+        flushed = _run(flush_query_history())
         
-        return {"status": "success", "processed": len(documents)}
+        return {"status": "success", "flushed": flushed}
         
     except Exception as e:
         return {"status": "error", "error": str(e)}
@@ -24,6 +24,7 @@ CREATE TABLE chunks (
     content TEXT NOT NULL,
     language VARCHAR(2) DEFAULT 'hr',
     embedding vector(1024),
+    embedding_quantized BYTEA,
     chunk_metadata JSONB DEFAULT '{}',
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
@@ -61,8 +62,7 @@ CREATE INDEX idx_chunks_language ON chunks(language);
 
 -- Vector similarity search index
 CREATE INDEX chunks_embedding_idx ON chunks 
-USING ivfflat (embedding vector_cosine_ops)
-WITH (lists = 100);
+USING hnsw (embedding vector_cosine_ops);
 
 -- Insert default categories based on actual document folders
 INSERT INTO categories (name, name_hr, name_en, description) VALUES
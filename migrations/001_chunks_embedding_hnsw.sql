@@ -0,0 +1,6 @@
+-- Replace the IVFFlat embedding index with HNSW.
+-- IVFFlat built on an empty table has useless centroids; HNSW needs no training data.
+DROP INDEX IF EXISTS chunks_embedding_idx;
+
+CREATE INDEX chunks_embedding_idx ON chunks 
+USING hnsw (embedding vector_cosine_ops);
\ No newline at end of file
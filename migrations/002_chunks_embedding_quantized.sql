@@ -0,0 +1,4 @@
+-- Compact int8 copy of each chunk embedding, read by VECTOR_SEARCH_MODE=exact.
+-- Existing chunks keep NULL here (re-processing skips documents that already have
+-- chunks); exact search scores those from the pgvector embedding column instead.
+ALTER TABLE chunks ADD COLUMN IF NOT EXISTS embedding_quantized BYTEA;
\ No newline at end of file